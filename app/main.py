@@ -1,44 +1,122 @@
 import atexit
+import concurrent.futures
+import io
+import json
 import os
 import shlex
 import subprocess
+import sys
 import shutil
 from contextlib import suppress
 from pathlib import Path
 import readline
 
+class Trie:
+    def __init__(self):
+        self.children: dict[str, Trie] = {}
+        self.is_terminal = False
+
+    def insert(self, word: str):
+        node = self
+        for char in word:
+            node = node.children.setdefault(char, Trie())
+        node.is_terminal = True
+
+    def complete(self, prefix: str) -> list[str]:
+        node = self
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return []
+        matches = []
+        stack = [(node, prefix)]
+        while stack:
+            node, word = stack.pop()
+            if node.is_terminal:
+                matches.append(word)
+            # Push in reverse so children are visited in insertion order
+            for char, child in reversed(node.children.items()):
+                stack.append((child, word + char))
+        return matches
+
+
 class Autocompleter:
     available_commands = ("echo", "type", "exit", "pwd", "cd")
+    cache_file = Path("~/.cache/shell-python/path_cache").expanduser()
 
     def __init__(self):
         self.options = self.get_options()
+        self.trie = Trie()
+        for option in self.options:
+            self.trie.insert(option)
         self.matches = []
+        self._display_matches = []
+        self.last_text = None
 
     def get_options(self):
-        options = list(self.available_commands)
-        options.extend(self._get_path_executable())
-        return options
+        options = set(self.available_commands)
+        options.update(self._load_path_executable())
+        return tuple(sorted(options))
 
     @staticmethod
-    def _get_path_executable():
+    def _get_path_signature():
+        signature = []
         for path in os.environ["PATH"].split(os.pathsep):
-            path = Path(path)
-            if path.exists():
-                for file in path.iterdir():
-                    if file.is_file() and shutil.which(file.name):
-                        yield file.name
+            with suppress(OSError):
+                signature.append([path, os.stat(path).st_mtime_ns])
+        return signature
+
+    @classmethod
+    def _load_path_executable(cls):
+        signature = cls._get_path_signature()
+        with suppress(OSError, ValueError):
+            with cls.cache_file.open() as f:
+                cache = json.load(f)
+            if (isinstance(cache, dict) and cache.get("signature") == signature
+                    and isinstance(executables := cache.get("executables"), list)
+                    and all(isinstance(name, str) for name in executables)):
+                return executables
+
+        executables = list(cls._get_path_executable())
+        tmp_file = cls.cache_file.with_name(f"{cls.cache_file.name}.{os.getpid()}")
+        try:
+            cls.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            with tmp_file.open("w") as f:
+                json.dump({"signature": signature, "executables": executables}, f)
+            os.replace(tmp_file, cls.cache_file)
+        except OSError:
+            with suppress(OSError):
+                tmp_file.unlink()
+        return executables
+
+    @staticmethod
+    def _scan_executables(path):
+        try:
+            with os.scandir(path) as it:
+                return [entry.name for entry in it
+                        if entry.is_file() and os.access(entry.path, os.X_OK)]
+        except OSError:
+            return []
+
+    @classmethod
+    def _get_path_executable(cls):
+        paths = os.environ["PATH"].split(os.pathsep)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+            for names in pool.map(cls._scan_executables, paths):
+                yield from names
 
     def complete(self, text, state):
-        if state == 0:
+        if state == 0 and text != self.last_text:
+            self.last_text = text
             if text:
-                self.matches = [option for option in self.options
-                                if option.startswith(text)]
+                self.matches = self.trie.complete(text)
             else:
-                self.matches = self.options[:]
+                self.matches = self.options
+            self._display_matches = [f"{match} " for match in self.matches]
 
         # Return match indexed by state
-        if state < len(self.matches):
-            return f"{self.matches[state]} "
+        if state < len(self._display_matches):
+            return self._display_matches[state]
         else:
             return None
 
@@ -48,53 +126,136 @@ class Autocompleter:
         print(" ".join(matches))
         print("$ " + readline.get_line_buffer(), end="", flush=True)
 
-completer = Autocompleter()
-readline.set_completer(completer.complete)
-readline.set_completion_display_matches_hook(Autocompleter.complete_hook)
-readline.parse_and_bind("tab: complete")
+completer = None
+
+def _lazy_complete(text, state):
+    # Build the completer on the first TAB so startup skips the PATH scan
+    global completer
+    if completer is None:
+        completer = Autocompleter()
+        readline.set_completer(completer.complete)
+    return completer.complete(text, state)
+
+if sys.stdin.isatty():
+    readline.set_completer(_lazy_complete)
+    readline.set_completion_display_matches_hook(Autocompleter.complete_hook)
+    readline.parse_and_bind("tab: complete")
 readline.set_auto_history(False)
 
 
+def _write_stdout(buf: bytes):
+    # Flush pending print() output first so ordering is preserved
+    sys.stdout.flush()
+    try:
+        fd = sys.stdout.fileno()
+    except io.UnsupportedOperation:
+        # stdout was replaced by an in-memory stream, e.g. redirect_stdout
+        sys.stdout.write(buf.decode())
+        return
+    view = memoryview(buf)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+_which_cache: dict[tuple[str, str], str] = {}
+
+
 class CommandHandler:
     TYPE_TEMPLATE = "{arg} is a shell builtin"
     TYPES_BUILTIN = {"echo", "type", "exit", "pwd", "history",}
+    HISTORY_LENGTH = 1000
+    SHELL_METACHARS = frozenset("|>")
+    QUOTING_CHARS = frozenset("'\"\\")
 
     def __init__(self):
         self.must_exit = False
-        self.last_append_index = 1
+        self._dispatch = {
+            "exit": self._do_exit,
+            "echo": self.handle_echo,
+            "type": self.handle_type,
+            "pwd": self.handle_pwd,
+            "cd": self.handle_cd,
+            "history": self._dispatch_history,
+        }
+        self._history_dispatch = {
+            "-a": self.append_to_history,
+            "-w": self.write_to_history_file,
+            "-r": self.handle_history_from_filename,
+        }
         self.load_history_file()
+        # Number of history entries HISTFILE already holds
+        self.persisted_history_length = readline.get_current_history_length()
+        self.last_append_index = self.persisted_history_length + 1
 
-    @staticmethod
-    def load_history_file():
+    @classmethod
+    def load_history_file(cls):
         with suppress(OSError):
             if hist_file := os.getenv("HISTFILE"):
-                path = Path(hist_file)
-                if path.exists():
-                    readline.read_history_file(path)
+                for line in cls.read_history_tail(Path(hist_file), cls.HISTORY_LENGTH):
+                    if line:
+                        readline.add_history(line)
+
     @staticmethod
-    def save_history_file():
+    def read_history_tail(path: Path, n: int) -> list[str]:
+        # Read backwards in blocks until the last n lines are buffered
+        with path.open("rb") as f:
+            pos = f.seek(0, os.SEEK_END)
+            data = b""
+            while pos > 0 and data.count(b"\n") <= n:
+                step = min(1 << 16, pos)
+                pos -= step
+                f.seek(pos)
+                data = f.read(step) + data
+        return [line.decode(errors="replace") for line in data.splitlines()[-n:]]
+
+    def save_history_file(self):
+        # Only the tail of HISTFILE was loaded, so append the entries it
+        # does not hold yet rather than rewriting the file from memory
         with suppress(OSError):
             if hist_file := os.getenv("HISTFILE"):
                 path = Path(hist_file)
                 if path.exists():
-                    readline.write_history_file(path)
+                    end = readline.get_current_history_length()
+                    if end > self.persisted_history_length:
+                        readline.append_history_file(end - self.persisted_history_length, path)
+                    self.persisted_history_length = end
 
     @staticmethod
-    def split_command(command: str) -> tuple[str, str]:
-        command, *arg = shlex.split(command)
+    def is_history_file(filename: str) -> bool:
+        hist_file = os.getenv("HISTFILE")
+        return bool(hist_file) and os.path.realpath(filename) == os.path.realpath(hist_file)
+
+    @classmethod
+    def _fast_split(cls, command: str) -> list[str]:
+        # Only fall back to shlex when there is quoting to interpret
+        if cls.QUOTING_CHARS.isdisjoint(command):
+            return command.split()
+        return shlex.split(command)
+
+    @classmethod
+    def split_command(cls, command: str) -> tuple[str, str]:
+        command, *arg = cls._fast_split(command)
         return command, arg
 
     @staticmethod
     def find_executable(command: str) -> str | None:
-        return shutil.which(command)
-
-    @staticmethod
-    def is_a_redirect(command: str) -> bool:
-        return ">" in command or "1>" in command
+        path = os.environ.get("PATH", os.defpath)
+        key = (command, path)
+        pathname = _which_cache.get(key)
+        if pathname is not None and os.access(pathname, os.X_OK):
+            return pathname
+        # Miss or stale hit, e.g. after installing or removing a binary
+        pathname = shutil.which(command, path=path)
+        if pathname is None:
+            _which_cache.pop(key, None)
+        else:
+            _which_cache[key] = pathname
+        return pathname
 
-    @staticmethod
-    def is_a_pipe(command: str) -> bool:
-        return "|" in command
+    @classmethod
+    def has_shell_metachars(cls, command: str) -> bool:
+        # Redirects (">", "1>") and pipes ("|") are all handed to the system shell
+        return not cls.SHELL_METACHARS.isdisjoint(command)
 
     @staticmethod
     def handle_echo(arg: str):
@@ -104,13 +265,13 @@ class CommandHandler:
         arg = "".join(arg)
         if arg in self.TYPES_BUILTIN:
             print(self.TYPE_TEMPLATE.format(arg=arg))
-        elif pathname := shutil.which(arg):
+        elif pathname := self.find_executable(arg):
             print(pathname)
         else:
             print(f"{arg}: not found")
 
     @staticmethod
-    def handle_pwd():
+    def handle_pwd(_):
         print(os.getcwd())
 
     @staticmethod
@@ -120,9 +281,10 @@ class CommandHandler:
 
     @staticmethod
     def handle_cd(arg: str):
-        arg = Path("".join(arg))
+        # Bare "cd" goes home, like a real shell
+        arg = "".join(arg) or "~"
         try:
-            os.chdir(arg.expanduser())
+            os.chdir(os.path.expanduser(arg))
         except FileNotFoundError:
             print(f"cd: {arg}: No such file or directory")
 
@@ -135,74 +297,89 @@ class CommandHandler:
         print(f"{command}: command not found")
 
     @staticmethod
-    def handle_indexed_history(n):
+    def write_history_range(start: int, end: int):
+        buf = b"".join(f"    {i}  {readline.get_history_item(i)}\n".encode() for i in range(start, end + 1))
+        _write_stdout(buf)
+
+    def handle_indexed_history(self, n):
         history_length = readline.get_current_history_length()
         n = int(n)
-        for i in range(history_length + 1 - n, history_length + 1):
-            print(f"    {i}  {readline.get_history_item(i)}")
+        self.write_history_range(history_length + 1 - n, history_length)
 
-    @staticmethod
-    def handle_history():
-        history_len = readline.get_current_history_length()
-        for i in range(1, history_len + 1):
-            print(f"    {i}  {readline.get_history_item(i)}")
+    def handle_history(self):
+        self.write_history_range(1, readline.get_current_history_length())
 
-    @staticmethod
-    def handle_history_from_filename(filename: str):
+    def handle_history_from_filename(self, filename: str):
+        # Clearing drops entries HISTFILE may not hold yet, so save them first
+        self.save_history_file()
         readline.clear_history()
         readline.add_history(f"history -r {filename}")
-        with Path(filename).open("r") as f:
-            for line in f:
-                readline.add_history(line.strip())
+        try:
+            readline.read_history_file(filename)
+        finally:
+            self.persisted_history_length = readline.get_current_history_length()
 
     @staticmethod
-    def write_to_history_file(filename: str):
-        with Path(filename).open("w") as f:
-            for i in range(1, readline.get_current_history_length() + 1):
-                f.write(f"{readline.get_history_item(i)}\n")
+    def get_history_bytes(start: int, end: int) -> bytes:
+        items = [readline.get_history_item(i) for i in range(start, end + 1)]
+        if not items:
+            return b""
+        return ("\n".join(items) + "\n").encode()
+
+    def write_to_history_file(self, filename: str):
+        end = readline.get_current_history_length()
+        with open(filename, "wb", buffering=1 << 16) as f:
+            f.write(self.get_history_bytes(1, end))
+        if self.is_history_file(filename):
+            self.persisted_history_length = end
 
     def append_to_history(self, filename: str):
-        with Path(filename).open("a") as f:
-            for i in range(self.last_append_index, readline.get_current_history_length() + 1):
-                f.write(f"{readline.get_history_item(i)}\n")
-            self.last_append_index = readline.get_current_history_length() + 1
-
+        end = readline.get_current_history_length()
+        with open(filename, "ab", buffering=1 << 16) as f:
+            f.write(self.get_history_bytes(self.last_append_index, end))
+        self.last_append_index = end + 1
+        if self.is_history_file(filename):
+            self.persisted_history_length = end
+
+
+    def _do_exit(self, _):
+        atexit.register(self.save_history_file)
+        self.must_exit = True
+
+    def _dispatch_history(self, arg):
+        flag = arg[0] if arg and arg[0].startswith("-") else None
+        if len(arg) == 2 and (fn := self._history_dispatch.get(flag)):
+            fn(arg[1])
+        elif len(arg) == 1:
+            self.handle_indexed_history(arg[0])
+        else:
+            self.handle_history()
 
     def handle_command(self, command: str):
-        if self.is_a_redirect(command) or self.is_a_pipe(command):
+        if self.has_shell_metachars(command):
             self.subprocess_call(command)
+            return
+
+        command, arg = self.split_command(command)
+        if fn := self._dispatch.get(command):
+            fn(arg)
+        elif self.find_executable(command):
+            self.handle_exec(command, arg)
         else:
-            match self.split_command(command):
-                case ("exit", _):
-                    atexit.register(self.save_history_file)
-                    self.must_exit = True
-                case ("echo", arg):
-                    self.handle_echo(arg)
-                case ("type", arg):
-                    self.handle_type(arg)
-                case ("pwd", _):
-                    self.handle_pwd()
-                case ("cd", arg):
-                    self.handle_cd(arg)
-
-                # -- History --
-                case ("history", ["-a", filename]):
-                    self.append_to_history(filename)
-                case ("history", ["-w", filename]):
-                    self.write_to_history_file(filename)
-                case ("history", ["-r", filename]):
-                    self.handle_history_from_filename(filename)
-                case ("history", [arg]):
-                    self.handle_indexed_history(arg)
-                case ("history", _):
-                    self.handle_history()
-                case (command, arg):
-                    if self.find_executable(command):
-                        self.handle_exec(command, arg)
-                    else:
-                        self.handle_default(command)
+            self.handle_default(command)
+
+    def run_script(self):
+        # Non-interactive input: no prompt, no readline history
+        for line in sys.stdin:
+            if command := line.strip():
+                self.handle_command(command)
+            if self.must_exit:
+                break
 
     def run(self):
+        if not sys.stdin.isatty():
+            self.run_script()
+            return
         while not self.must_exit:
             user_input = input("$ ").strip()
             readline.add_history(user_input)